@@ -1,73 +1,425 @@
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import hashlib
 import json
-from statistics import mean
+import math
+import os
+from pathlib import Path
+import tempfile
+import warnings
 from glob import glob
-from typing import Sequence, Iterator, List, Mapping, Tuple
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    TextIO,
+    Tuple,
+    TypeVar,
+)
 
-from PIL import Image
-from PIL.ImageChops import difference
-from PIL.ImageFile import ImageFile
-from PIL.ImageStat import Stat
+import cv2
+import numpy as np
 from tqdm import tqdm
 
+try:
+    import numba
+except ImportError:  # Fall back to the NumPy implementation.
+    numba = None
+
+try:
+    from turbojpeg import TJPF_GRAY, TurboJPEG
+
+    turbojpeg = TurboJPEG()
+except (ImportError, RuntimeError):  # The package or libturbojpeg is missing.
+    turbojpeg = None
+
+
+T = TypeVar("T")
+
+# Counterclockwise rotations by 90°, 180° and 270°, in quarter turns.
+ROTATIONS = [1, 2, 3]
+
+# Resized images are memoized here across runs. Bump CACHE_VERSION whenever
+# load_image() starts producing different arrays.
+CACHE_DIR = (
+    Path(os.environ.get("XDG_CACHE_HOME", "~/.cache")).expanduser() / "imagesearch"
+)
+CACHE_VERSION = 4
+
+# Size (bytes) of the L2 cache the operands of a block should fit in.
+L2_BYTES = 256 * 1024
+
+# Image groups larger than this (bytes) are backed by a memory-mapped file,
+# created in MEMMAP_DIR unless --memmap-dir says otherwise. /tmp is often a
+# tmpfs, i.e. RAM, so default to the disk-backed /var/tmp where it exists.
+MEMMAP_BYTES = 256 * 1024 * 1024
+MEMMAP_DIR = "/var/tmp" if os.path.isdir("/var/tmp") else tempfile.gettempdir()
+
+# Upper bound (bytes) of the float16 temporary of one chunk on the GPU.
+CUDA_CHUNK_BYTES = 256 * 1024 * 1024
+
+# Default --threshold of each metric. meandiff compares grayscale pixels; 27
+# accepts as many unrelated pairs as 30 did when the mean was taken over the
+# B, G and R channels.
+THRESHOLDS = {"meandiff": 27, "dhash": 10}
+
+# Number of set bits of every byte value.
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def decode_jpeg(path: str, size: int) -> Optional[np.ndarray]:
+    """Decode a JPEG in grayscale with libjpeg-turbo, downscaling it while
+    decoding as far as possible without any side getting below `size`.
+
+    Return None if libjpeg-turbo cannot decode the file.
+    """
+    with open(path, "rb") as fp:
+        buf = fp.read()
+    try:
+        width, height, _, _ = turbojpeg.decode_header(buf)
+        factors = [
+            (num, denom)
+            for num, denom in turbojpeg.scaling_factors
+            if min(-(-width * num // denom), -(-height * num // denom)) >= size
+        ]
+        factor = min(factors, key=lambda f: f[0] / f[1], default=None)
+        image = turbojpeg.decode(buf, pixel_format=TJPF_GRAY, scaling_factor=factor)
+    except OSError:
+        return None
+    return image[:, :, 0]
 
-ANGLES = [90, 180, 270]
 
+def uses_turbojpeg(path: str) -> bool:
+    return turbojpeg is not None and path.lower().endswith((".jpg", ".jpeg"))
 
-def meandiff(image1: ImageFile, image2: ImageFile) -> float:
-    return float(mean(Stat(difference(image1, image2)).mean))
 
+def load_image(path: str, size: int) -> np.ndarray:
+    # A single luminance channel is enough to tell images apart, and it is a
+    # third of the bytes to move around compared with BGR.
+    image = None
+    if uses_turbojpeg(path):
+        image = decode_jpeg(path, size)
+    if image is None:
+        # Like libjpeg-turbo (and PIL before it), ignore the EXIF orientation
+        # so that both decoders agree and --rotate sees the stored pixels.
+        image = cv2.imread(path, cv2.IMREAD_GRAYSCALE | cv2.IMREAD_IGNORE_ORIENTATION)
+    if image is None:
+        raise ValueError(f"Cannot read image: {path}")
+    # Every image is stretched to the same square so that the whole group can
+    # be stacked into a single array. Thumbnails keep the aspect ratio of the
+    # originals, so stretching both sides alike does not affect the comparison.
+    return cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA)
 
-def resize_to_fit(image: ImageFile, size: int) -> ImageFile:
-    rate = size / max(image.width, image.height)
-    new_image = image.resize((int(image.width * rate), int(image.height * rate)))
-    return new_image
 
+def load_cached_image(path: str, size: int) -> np.ndarray:
+    """Same as load_image, but reuse the result of previous runs if possible."""
+    path = os.path.abspath(path)
+    # The decoders produce slightly different pixels, so keep their entries
+    # apart.
+    decoder = "turbojpeg" if uses_turbojpeg(path) else "opencv"
+    key = f"{CACHE_VERSION}\0{decoder}\0{path}\0{os.path.getmtime(path)}\0{size}"
+    cache_path = CACHE_DIR / f"{hashlib.sha1(key.encode('utf8')).hexdigest()}.npy"
+    if cache_path.exists():
+        return np.load(cache_path, mmap_mode="r")
+    image = load_image(path, size)
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    # Write to a temporary file first so that an interrupted run never leaves
+    # a truncated entry behind.
+    with tempfile.NamedTemporaryFile(dir=CACHE_DIR, suffix=".tmp", delete=False) as fp:
+        np.save(fp, image)
+    os.replace(fp.name, cache_path)
+    return image
 
-def rotate_to_multiple_angles(image: ImageFile) -> List[ImageFile]:
-    return [image] + [image.rotate(angle, expand=True) for angle in ANGLES]
+
+# Kernels compiled by make_kernel(), by image shape.
+KERNELS: Dict[Tuple[int, int], Callable[..., None]] = {}
+
+
+def make_kernel(h: int, w: int) -> Callable[..., None]:
+    """Return a Numba kernel specialized for (h, w) images.
+
+    The image shape is baked into the kernel as a constant so that Numba can
+    unroll and vectorize the inner loops. Requires numba.
+    """
+    if (h, w) in KERNELS:
+        return KERNELS[h, w]
+    scale = 1 / (h * w)
+
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def pairwise_meandiff(
+        a: np.ndarray,
+        b: np.ndarray,
+        order: np.ndarray,
+        lo: np.ndarray,
+        hi: np.ndarray,
+        out: np.ndarray,
+    ) -> None:
+        """Write the mean absolute difference of a[i] and b[j] to out[i, j].
+
+        Only the pairs with j in order[lo[i]:hi[i]] are computed.
+        """
+        for i in numba.prange(a.shape[0]):
+            for jj in range(lo[i], hi[i]):
+                j = order[jj]
+                s = 0
+                for y in range(h):
+                    for x in range(w):
+                        d = np.int32(a[i, y, x]) - np.int32(b[j, y, x])
+                        s += d if d >= 0 else -d
+                out[i, j] = s * scale
+
+    KERNELS[h, w] = pairwise_meandiff
+    return pairwise_meandiff
+
+
+def progress(it: Iterable[T], total: int) -> Iterable[T]:
+    # Refresh the bar about 200 times in total and at most twice a second, so
+    # that it costs next to nothing even when iterations are very fast.
+    return tqdm(
+        it, total=total, mininterval=0.5, miniters=max(1, total // 200), smoothing=0
+    )
+
+
+def rotate_to_multiple_angles(image: np.ndarray) -> List[np.ndarray]:
+    # Quarter turns are exact, so views suffice; the caller copies them once
+    # into the group's array.
+    return [image] + [np.rot90(image, rotation) for rotation in ROTATIONS]
 
 
 class ImageGroup:
-    def __init__(self, paths: Sequence[str], size: int, verbose: bool, rotate) -> None:
+    def __init__(
+        self,
+        paths: Sequence[str],
+        size: int,
+        verbose: bool,
+        rotate,
+        cache: bool,
+        memmap_dir: str = MEMMAP_DIR,
+    ) -> None:
         self.size = size
         self.verbose = verbose
-        if self.verbose:
-            print("Loading images...")
-            it = tqdm(paths)
+        # Every path is repeated once per variant (rotation) of its image.
+        variants = 1 + len(ROTATIONS) if rotate else 1
+        self.paths = [path for path in paths for _ in range(variants)]
+        shape = (len(self.paths), size, size)
+        # Large groups live in an anonymous file on disk instead of in the
+        # process's memory: the pages are clean file-backed pages, so under
+        # memory pressure the OS can drop them and read them back on demand
+        # rather than keeping the whole group resident.
+        if np.prod(shape) > MEMMAP_BYTES:
+            backing = tempfile.TemporaryFile(dir=memmap_dir)
+            self.data = np.memmap(backing, dtype=np.uint8, mode="w+", shape=shape)
         else:
-            it = paths
-        resized_images = [(path, resize_to_fit(Image.open(path), size)) for path in it]
-        if rotate:
-            rotated_images = [
-                (path, rotated_image)
-                for path, image in resized_images
-                for rotated_image in rotate_to_multiple_angles(image)
-            ]
-            self.images = rotated_images
-        else:
-            self.images = resized_images
+            backing = None
+            self.data = np.empty(shape, dtype=np.uint8)
+        # OpenCV releases the GIL while decoding and resizing, so threads are
+        # enough to spread the work across all cores.
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            load = load_cached_image if cache else load_image
+            it = executor.map(partial(load, size=size), paths)
+            if self.verbose:
+                print("Loading images...")
+                it = progress(it, len(paths))
+            for i, image in enumerate(it):
+                if rotate:
+                    images = rotate_to_multiple_angles(image)
+                else:
+                    images = [image]
+                self.data[i * variants : (i + 1) * variants] = images
+        if backing is not None:
+            self.data.flush()
+            # Copy-on-write rather than read-only, so that consumers expecting
+            # a writable array (such as torch.from_numpy) accept it as is.
+            self.data = np.memmap(backing, dtype=np.uint8, mode="c", shape=shape)
 
-    def __iter__(self) -> Iterator[ImageFile]:
-        return iter(self.images)
+    def __iter__(self) -> Iterator[Tuple[str, np.ndarray]]:
+        return zip(self.paths, self.data)
 
     def __len__(self) -> int:
-        return len(self.images)
+        return len(self.paths)
+
+    def hashes(self) -> np.ndarray:
+        """Compute the 64-bit difference hash (dHash) of every image."""
+        bits = np.empty((len(self), 8, 8), dtype=bool)
+        for i, image in enumerate(self.data):
+            small = cv2.resize(image, (9, 8), interpolation=cv2.INTER_AREA)
+            bits[i] = small[:, 1:] > small[:, :-1]
+        return np.packbits(bits.reshape(len(self), 64), axis=1).view(np.uint64)[:, 0]
+
+    def meandiff(
+        self, other: "ImageGroup", threshold: float
+    ) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """Yield blocks (rows, diffs) of the (N, M) matrix of mean absolute
+        pixel differences, `diffs` holding the full rows listed in `rows`.
 
-    def meandiff(self, image: ImageFile) -> List[Tuple[str, float]]:
-        return [(path, meandiff(image, im)) for path, im in self]
+        Pairs that cannot be below `threshold` are skipped and left as inf.
+        When comparing a group with itself, only one of (i, j) and (j, i) is
+        computed.
+        """
+        a = self.data
+        b = other.data
+        # Comparing a group with itself gives a symmetric matrix, so only the
+        # pairs at or above the diagonal (in anchor order) are computed.
+        symmetric = other is self
+        # The mean difference to a black image bounds the mean difference
+        # between two images from below (triangle inequality), so with `b`
+        # sorted by it, the candidates of each image in `a` form one slice.
+        anchor_a = a.mean(axis=(1, 2))
+        anchor_b = b.mean(axis=(1, 2))
+        order_b = np.argsort(anchor_b)
+        sorted_b = anchor_b[order_b]
+        if numba is not None:
+            lo = np.searchsorted(sorted_b, anchor_a - threshold, side="left")
+            hi = np.searchsorted(sorted_b, anchor_a + threshold, side="right")
+            if symmetric:
+                rank = np.empty_like(order_b)
+                rank[order_b] = np.arange(len(order_b))
+                lo = np.maximum(lo, rank)
+            # The kernel parallelizes over rows; hand it a few rows per core
+            # at a time so that the progress bar keeps moving.
+            step = 4 * (os.cpu_count() or 1)
+            pairwise_meandiff = make_kernel(*a.shape[1:])
+            for i0 in self._progress(range(0, len(a), step)):
+                i1 = min(i0 + step, len(a))
+                diffs = np.full((i1 - i0, len(b)), np.inf, dtype=np.float32)
+                pairwise_meandiff(a[i0:i1], b, order_b, lo[i0:i1], hi[i0:i1], diffs)
+                yield np.arange(i0, i1), diffs
+            return
+        # The int16 differences of a block of `step` rows and `step` columns go
+        # to one scratch buffer that is reused across all blocks. `step` is
+        # chosen so that the scratch buffer, the largest operand by far, fits
+        # in L2. Rows are sorted too, so that each block of rows only meets one
+        # slice of columns.
+        step = max(1, math.isqrt(L2_BYTES // (2 * self.size * self.size)))
+        scratch = np.empty((step, step) + a.shape[1:], dtype=np.int16)
+        order_a = order_b if symmetric else np.argsort(anchor_a)
+        for i0 in self._progress(range(0, len(a), step)):
+            rows = order_a[i0 : i0 + step]
+            block = a[rows][:, None]
+            diffs = np.full((len(rows), len(b)), np.inf, dtype=np.float32)
+            lo = np.searchsorted(sorted_b, anchor_a[rows[0]] - threshold)
+            hi = np.searchsorted(sorted_b, anchor_a[rows[-1]] + threshold, side="right")
+            if symmetric:
+                lo = max(lo, i0)
+            for j0 in range(lo, hi, step):
+                cols = order_b[j0 : min(j0 + step, hi)]
+                buf = scratch[: len(rows), : len(cols)]
+                np.subtract(block, b[cols][None], out=buf, dtype=np.int16)
+                np.abs(buf, out=buf)
+                diffs[:, cols] = buf.mean(axis=(2, 3))
+            yield rows, diffs
 
-    def filter_similar(self, image: ImageFile, threshold: float) -> List[str]:
-        return [path for path, diff in self.meandiff(image) if diff < threshold]
+    def meandiff_cuda(
+        self, other: "ImageGroup"
+    ) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """Same as meandiff, but computed on the GPU with PyTorch.
 
-    def lookup(self, other: "ImageGroup", threshold: float) -> Mapping[str, List[str]]:
+        No pairs are skipped: brute force is cheap enough there.
+        """
+        import torch
+
+        a = torch.from_numpy(self.data).to("cuda", torch.float16)
+        if other is self:
+            b = a
+        else:
+            b = torch.from_numpy(other.data).to("cuda", torch.float16)
+        # Differences of uint8 values are exact in float16. The mean itself is
+        # returned in float32: float16 is too coarse near the threshold (1/64
+        # around 30) and would disagree with the CPU path on borderline pairs.
+        step = max(1, CUDA_CHUNK_BYTES // (2 * max(1, b.numel())))
+        for i0 in self._progress(range(0, len(a), step)):
+            chunk = (a[i0 : i0 + step, None] - b[None]).abs_()
+            chunk = chunk.mean(dim=(2, 3), dtype=torch.float32)
+            yield np.arange(i0, i0 + len(chunk)), chunk.cpu().numpy()
+
+    def hamming(self, other: "ImageGroup") -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """Yield blocks (rows, diffs) of the (N, M) matrix of Hamming distances
+        between the dHashes."""
+        a = self.hashes()
+        b = a if other is self else other.hashes()
+        # Popcount 8 bytes per pair through a lookup table; `step` rows at a
+        # time keep the (step, M, 8) temporary within L2.
+        step = max(1, L2_BYTES // (8 * max(1, len(b))))
+        for i0 in self._progress(range(0, len(a), step)):
+            xor = a[i0 : i0 + step, None] ^ b[None]
+            diffs = POPCOUNT[xor.view(np.uint8)].reshape(*xor.shape, 8).sum(axis=2)
+            yield np.arange(i0, i0 + len(xor)), diffs
+
+    def lookup(
+        self, other: "ImageGroup", threshold: float, metric: str, device: str
+    ) -> Iterator[Tuple[str, List[str]]]:
+        """Yield each path of this group with the similar paths of `other`."""
         if self.verbose:
             print("Comparing images...")
-            it = tqdm(self)
+        if metric == "dhash":
+            blocks = self.hamming(other)
+        elif device == "cuda":
+            blocks = self.meandiff_cuda(other)
         else:
-            it = self
-        diffs = {path: other.filter_similar(image, threshold) for path, image in it}
-        return diffs
+            blocks = self.meandiff(other, threshold)
+        for i, similar in self._matches(blocks, threshold, other is self):
+            yield self.paths[i], [other.paths[j] for j in similar]
+
+    def _matches(
+        self,
+        blocks: Iterable[Tuple[np.ndarray, np.ndarray]],
+        threshold: float,
+        symmetric: bool,
+    ) -> Iterator[Tuple[int, List[int]]]:
+        """Turn blocks of rows of a difference matrix into the indices of the
+        pairs below `threshold`, yielded row by row in order.
+
+        Only these indices are kept, never the differences themselves. A row
+        is yielded as soon as it and all rows before it are complete. With
+        `symmetric`, every pair is mirrored, so all rows complete at the end.
+        """
+        pending: Dict[int, Set[int]] = {}
+        done = 0
+        for rows, diffs in blocks:
+            for i, row in zip(rows.tolist(), diffs):
+                similar = np.flatnonzero(row < threshold).tolist()
+                pending.setdefault(i, set()).update(similar)
+                if symmetric:
+                    for j in similar:
+                        pending.setdefault(j, set()).add(i)
+            while not symmetric and done in pending:
+                yield done, sorted(pending.pop(done))
+                done += 1
+        for i in range(done, len(self)):
+            yield i, sorted(pending.pop(i, ()))
+
+    def _progress(self, it: Sequence[int]) -> Iterable[int]:
+        return progress(it, len(it)) if self.verbose else it
+
+
+def dump_items(items: Iterable[Tuple[str, List[str]]], fp: TextIO) -> None:
+    """Write `items` to `fp` as a JSON object, one item at a time.
+
+    The output is the same as json.dump(dict(items), fp), but only one item
+    needs to be held in memory.
+    """
+    fp.write("{")
+    for i, (key, value) in enumerate(items):
+        if i:
+            fp.write(", ")
+        fp.write(f"{json.dumps(key)}: {json.dumps(value)}")
+    fp.write("}")
+
+
+def cuda_available() -> bool:
+    # PyTorch is only imported when --device cuda asks for it: importing it
+    # takes seconds.
+    try:
+        import torch
+    except ImportError:
+        return False
+    return torch.cuda.is_available()
 
 
 def main(
@@ -76,16 +428,51 @@ def main(
     outpath: str,
     size: int,
     rotate: bool,
-    threshold: int,
+    threshold: Optional[int],
+    metric: str,
+    device: str,
+    no_cache: bool,
+    memmap_dir: str,
     verbose: bool,
 ) -> None:
+    if threshold is None:
+        threshold = THRESHOLDS[metric]
+    if device == "cuda" and metric == "dhash":
+        warnings.warn("--device cuda only applies to meandiff. Using the CPU.")
+        device = "cpu"
+    elif device == "cuda" and not cuda_available():
+        warnings.warn("CUDA is not available. Falling back to the CPU.")
+        device = "cpu"
     paths1 = glob(pattern1)
     paths2 = glob(pattern2)
-    grp1 = ImageGroup(paths1, size, verbose, False)
-    grp2 = ImageGroup(paths2, size, verbose, rotate)
-    similar_images = grp1.lookup(grp2, threshold)
-    with open(outpath, "w", encoding="utf8") as fp:
-        json.dump(similar_images, fp)
+    grp1 = ImageGroup(paths1, size, verbose, False, not no_cache, memmap_dir)
+    if paths1 == paths2 and not rotate:
+        grp2 = grp1
+    else:
+        grp2 = ImageGroup(paths2, size, verbose, rotate, not no_cache, memmap_dir)
+    similar_images = grp1.lookup(grp2, threshold, metric, device)
+    # The comparison runs while the result is written, so write to a temporary
+    # file and only replace `outpath` once it is complete. An interrupted run
+    # leaves the previous result intact.
+    with tempfile.NamedTemporaryFile(
+        "w",
+        encoding="utf8",
+        dir=os.path.dirname(os.path.abspath(outpath)),
+        suffix=".tmp",
+        delete=False,
+    ) as fp:
+        try:
+            dump_items(similar_images, fp)
+        except BaseException:
+            fp.close()
+            os.remove(fp.name)
+            raise
+    # NamedTemporaryFile is only readable by its owner; give the result the
+    # permissions open() would have.
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(fp.name, 0o666 & ~umask)
+    os.replace(fp.name, outpath)
 
 
 parser = ArgumentParser(
@@ -127,11 +514,51 @@ parser.add_argument(
 parser.add_argument(
     "--threshold",
     type=int,
-    default=30,
+    default=None,
     help=(
         "The images would be considered 'the same' "
-        "if the mean difference of the pixel values is below this threshold. "
-        "Defaults to 30."
+        "if their difference (see --metric) is below this threshold. "
+        "Defaults to 27 for meandiff and 10 for dhash."
+    ),
+)
+parser.add_argument(
+    "--metric",
+    choices=["meandiff", "dhash"],
+    default="meandiff",
+    help=(
+        "How to measure the difference between two images. "
+        "meandiff: the mean difference of the grayscale pixel values (0-255). "
+        "dhash: the number of differing bits of their 64-bit difference hashes, "
+        "much faster but coarser. "
+        "Defaults to meandiff."
+    ),
+)
+parser.add_argument(
+    "--device",
+    choices=["cpu", "cuda"],
+    default="cpu",
+    help=(
+        "Where to compute the meandiff metric. "
+        "cuda requires PyTorch and falls back to cpu if no GPU is available. "
+        "Defaults to cpu."
+    ),
+)
+parser.add_argument(
+    "--no-cache",
+    action="store_true",
+    help=(
+        "Do not read or write the resized images cached under "
+        "$XDG_CACHE_HOME/imagesearch (~/.cache/imagesearch by default)."
+    ),
+)
+parser.add_argument(
+    "--memmap-dir",
+    type=str,
+    default=MEMMAP_DIR,
+    help=(
+        "Where to put the temporary files backing image groups larger than "
+        f"{MEMMAP_BYTES // 1024 // 1024}MB. Should be on disk, not on a tmpfs. "
+        f"Defaults to {MEMMAP_DIR}."
     ),
 )
 parser.add_argument("--verbose", action="store_true", help="Display progress bars.")